@@ -14,6 +14,16 @@ def main():
         # stratiges: "strict", "double_interleaving", "full_interleaving",
         "sequential_order_constraint_strategy": "strict",
         "max_activation_times": [4, 3, 2, 1],
+        # disable when microbatches are no longer interchangeable
+        "break_microbatch_symmetry": True,
+        # stop searching after this many milliseconds, None to disable
+        "timeout_ms": None,
+        # solver logic: "QF_LIA" (integer offsets) or "QF_BV" (bit-vector offsets)
+        "solver_logic": "QF_LIA",
+        # directory caching the built constraints per config, None to disable
+        "constraint_cache_dir": ".z3cache",
+        # z3 global parameters overriding the simulator defaults
+        "z3_params": {},
     }
 
     simulator = Simulator(config)
@@ -0,0 +1,78 @@
+"""
+fast scheduler package
+"""
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError:  # numba is optional, fall back to plain python
+
+    def njit(*args, **kwargs):
+        """no-op replacement of numba.njit"""
+        del args, kwargs
+        return lambda func: func
+
+
+@njit(cache=True)
+def schedule_1f1b(pp_size, num_microbatches, forward_length, backward_length, max_act):
+    """greedy 1F1B list scheduling in strict sequential order.
+
+    Every pipeline runs forwards and backwards in microbatch order, prefers a
+    ready backward, and only starts a new forward while the activation count
+    stays within max_act. Returns the forward and backward start offsets as two
+    int64[pp_size, num_microbatches] arrays, filled with -1 if no pipeline can
+    make progress under the activation limits.
+    """
+    forward_starts = np.full((pp_size, num_microbatches), -1, dtype=np.int64)
+    backward_starts = np.full((pp_size, num_microbatches), -1, dtype=np.int64)
+    next_forward = np.zeros(pp_size, dtype=np.int64)
+    next_backward = np.zeros(pp_size, dtype=np.int64)
+    free_time = np.zeros(pp_size, dtype=np.int64)
+
+    for _ in range(2 * pp_size * num_microbatches):
+        best_start, best_is_forward, best_pp = -1, 0, -1
+
+        for pp in range(pp_size):
+            mb = next_backward[pp]
+            if mb < num_microbatches:
+                if pp == pp_size - 1:
+                    ready = forward_starts[pp, mb]
+                    if ready >= 0:
+                        ready += forward_length
+                else:
+                    ready = backward_starts[pp + 1, mb]
+                    if ready >= 0:
+                        ready += backward_length
+                if ready >= 0:
+                    start = max(free_time[pp], ready)
+                    if best_pp < 0 or (start, 0) < (best_start, best_is_forward):
+                        best_start, best_is_forward, best_pp = start, 0, pp
+
+            mb = next_forward[pp]
+            if mb < num_microbatches and mb - next_backward[pp] < max_act[pp]:
+                if pp == 0:
+                    ready = 0
+                else:
+                    ready = forward_starts[pp - 1, mb]
+                    if ready >= 0:
+                        ready += forward_length
+                if ready >= 0:
+                    start = max(free_time[pp], ready)
+                    # ties are resolved in favor of backwards
+                    if best_pp < 0 or (start, 1) < (best_start, best_is_forward):
+                        best_start, best_is_forward, best_pp = start, 1, pp
+
+        if best_pp < 0:
+            # no pipeline can make progress under the activation limits
+            break
+
+        if best_is_forward:
+            forward_starts[best_pp, next_forward[best_pp]] = best_start
+            next_forward[best_pp] += 1
+            free_time[best_pp] = best_start + forward_length
+        else:
+            backward_starts[best_pp, next_backward[best_pp]] = best_start
+            next_backward[best_pp] += 1
+            free_time[best_pp] = best_start + backward_length
+
+    return forward_starts, backward_starts
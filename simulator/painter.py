@@ -1,7 +1,12 @@
 """
 painter package
 """
+import re
 import tkinter as tk
+from collections import defaultdict
+
+# microbatch key: "{f|b}_{microbatch id}_{pipeline id}"
+_KEY_RE = re.compile(r"([fb])_(\d+)_(\d+)")
 
 
 class SchedulingPainter:
@@ -18,24 +23,24 @@ class SchedulingPainter:
         self._tk_root = tk.Tk()
         self._tk_root.title("SchedulingPainter")
 
-        self._highlight_state = {}
+        self._highlighted = set()
         self._item2color = {}
-        self._item2block = {}
+        self._text2block = {}
         self._item2mid = {}
+        self._mid2items = defaultdict(list)
 
     def _highlight_and_resume_block(self, canvas, item_id):
-        if self._highlight_state[item_id]:
-            self._highlight_state[item_id] = False
+        if item_id in self._highlighted:
+            self._highlighted.discard(item_id)
             canvas.itemconfig(item_id, fill=self._item2color[item_id])
         else:
-            self._highlight_state[item_id] = True
+            self._highlighted.add(item_id)
             canvas.itemconfig(item_id, fill="yellow")
 
     def _parse_microbatch_key(self, key: str):
-        is_forward = key.startswith("f")
-        mid, pid = key.split("_")[1:]
+        match = _KEY_RE.match(key)
 
-        return is_forward, int(pid), int(mid)
+        return match[1] == "f", int(match[3]), int(match[2])
 
     def draw(self, data: dict) -> None:
         """draw with tkinter"""
@@ -86,21 +91,17 @@ class SchedulingPainter:
             x1 = x0 + (self._forward_length if is_forward else self._backward_length)
             y1 = (self._pp_height + self._pp_align) * (pid + 1) - 5
 
-            tag = f"p_{pid}_m_{mid}_{'f' if is_forward else 'b'}"
             color = "#00FF7F" if is_forward else "#00BFFF"
 
-            block = main_canvas.create_rectangle(x0, y0, x1, y1, fill=color, tags=tag)
+            block = main_canvas.create_rectangle(x0, y0, x1, y1, fill=color)
             text = main_canvas.create_text(
                 (x0 + x1) // 2, (y0 + y1) // 2, text=f"{mid+1}"
             )
 
-            # print(f"block {tag}: {x0}, {y0}, {x1}, {y1}", flush=True)
-
-            self._highlight_state[block] = False
             self._item2color[block] = color
-            self._item2block[block] = block
-            self._item2block[text] = block
+            self._text2block[text] = block
             self._item2mid[block] = mid
+            self._mid2items[mid].append(block)
 
         # Register hook for highlighting execution block of this microbatch
         def _trigger_hook(event):
@@ -110,8 +111,11 @@ class SchedulingPainter:
             if len(items) == 0:
                 return
 
-            current_item = self._item2block[items[0]]
-            if current_item not in self._highlight_state:
+            if items[0] in self._text2block:
+                current_item = self._text2block[items[0]]
+            else:
+                current_item = items[0]
+            if current_item not in self._item2mid:
                 return
 
             item_coords = main_canvas.coords(current_item)
@@ -121,18 +125,7 @@ class SchedulingPainter:
                 coords_label, text=f"({current_start},{current_end})"
             )
 
-            tags = [
-                f"p_{pid}_m_{self._item2mid[current_item]}_{fb}"
-                for pid in range(self._pp_size)
-                for fb in ("f", "b")
-            ]
-            items_same_microbatch = []
-            for tag in tags:
-                found = main_canvas.find_withtag(tag)
-                if len(found) != 0:
-                    items_same_microbatch.append(found[0])
-
-            for item in items_same_microbatch:
+            for item in self._mid2items[self._item2mid[current_item]]:
                 self._highlight_and_resume_block(main_canvas, item)
 
         main_canvas.bind("<Button-1>", _trigger_hook)
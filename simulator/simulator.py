@@ -1,8 +1,14 @@
 """
 simulator package
 """
-import itertools
+import hashlib
+import json
+import os
+import tempfile
+import time
+import numpy as np
 import z3
+from .fast_sched import schedule_1f1b
 from .painter import SchedulingPainter
 
 
@@ -19,6 +25,10 @@ class Simulator:
         self._sequential_order_constraint_strategy = config[
             "sequential_order_constraint_strategy"
         ]
+        self._break_microbatch_symmetry = config.get("break_microbatch_symmetry", True)
+        self._timeout_ms = config.get("timeout_ms")
+        self._solver_logic = config.get("solver_logic", "QF_LIA")
+        self._constraint_cache_dir = config.get("constraint_cache_dir")
 
         assert isinstance(
             self._forward_length, int
@@ -27,150 +37,296 @@ class Simulator:
             self._backward_length, int
         ), "backward_execution_time must be int"
 
+        assert (
+            len(self._max_activation_times) == self._pp_size
+        ), "max_activation_times must have one entry per pipeline"
+
         assert self._sequential_order_constraint_strategy in (
             "strict",
             "double_interleaving",
             "full_interleaving",
         ), "sequential order constraint strategy is not supported"
 
-        self._solver = z3.Optimize()
+        assert self._solver_logic in (
+            "QF_LIA",
+            "QF_BV",
+        ), "solver logic is not supported"
+
+        # running every microbatch through the whole pipeline one after
+        # another is always feasible, so no schedule needs to end later
+        self._makespan_upper_bound = (
+            self._num_microbatches
+            * self._pp_size
+            * (self._forward_length + self._backward_length)
+        )
+
+        # every stage has to run all of its blocks, and a single microbatch
+        # has to pass through every stage, so no schedule can end earlier
+        self._makespan_lower_bound = max(self._num_microbatches, self._pp_size) * (
+            self._forward_length + self._backward_length
+        )
+        if self._sequential_order_constraint_strategy == "strict":
+            # the last pipeline cannot start before the first forward reaches it,
+            # and its last backward still has to pass through all other pipelines
+            self._makespan_lower_bound = (
+                self._num_microbatches + self._pp_size - 1
+            ) * (self._forward_length + self._backward_length)
+
+        # z3 global parameters, the defaults use every core and the new simplex
+        num_cpus = os.cpu_count() or 1
+        z3_params = {
+            "parallel.enable": True,
+            "parallel.threads.max": num_cpus,
+            "smt.arith.solver": 6,
+            "sat.threads": min(4, num_cpus),
+        }
+        z3_params.update(config.get("z3_params", {}))
+        for key, val in z3_params.items():
+            z3.set_param(key, val)
+
+        # bit-vector offsets hold the makespan upper bound plus a sign bit, so
+        # block ends never overflow and signed comparisons stay correct
+        self._bit_width = self._makespan_upper_bound.bit_length() + 1
+
+        # z3 terms of the execution times, shared by all constraints
+        self._z3_forward_length = self._make_val(self._forward_length)
+        self._z3_backward_length = self._make_val(self._backward_length)
+
+        # built constraints only depend on these config entries, the z3 version
+        # and the code building them
+        constraint_config = {
+            key: config.get(key)
+            for key in (
+                "pp_size",
+                "num_microbatches",
+                "max_activation_times",
+                "forward_execution_time",
+                "backward_execution_time",
+                "sequential_order_constraint_strategy",
+                "solver_logic",
+            )
+        }
+        with open(__file__, "rb") as source_file:
+            source = source_file.read()
+        self._constraint_cache_key = hashlib.sha1(
+            json.dumps(constraint_config, sort_keys=True).encode()
+            + z3.get_version_string().encode()
+            + source
+        ).hexdigest()
+
+        self._solver = z3.SolverFor(self._solver_logic)
         self._forward_offsets = [[] for i in range(self._pp_size)]
         self._backward_offsets = [[] for i in range(self._pp_size)]
+        self._all_vars = []
+        self._objective = None
+        self._timed_out = False
+
+    def _make_var(self, name: str):
+        if self._solver_logic == "QF_BV":
+            return z3.BitVec(name, self._bit_width)
+        return z3.Int(name)
+
+    def _make_val(self, val: int):
+        if self._solver_logic == "QF_BV":
+            return z3.BitVecVal(val, self._bit_width)
+        return z3.IntVal(val)
 
     def _sequential_order_constraint_strict(self):
+        cs = []
         for mb in range(self._num_microbatches):
             # forward stages sequential constraint
             for i in range(1, self._pp_size):
-                self._solver.add(
+                cs.append(
                     self._forward_offsets[i][mb]
-                    >= self._forward_offsets[i - 1][mb] + self._forward_length
+                    >= self._forward_offsets[i - 1][mb] + self._z3_forward_length
                 )
             # backward stages sequential constraint
             for i in range(self._pp_size - 1, 0, -1):
-                self._solver.add(
+                cs.append(
                     self._backward_offsets[i - 1][mb]
-                    >= self._backward_offsets[i][mb] + self._backward_length
+                    >= self._backward_offsets[i][mb] + self._z3_backward_length
                 )
             # forward-backward connection sequential constraint
-            self._solver.add(
+            cs.append(
                 self._backward_offsets[self._pp_size - 1][mb]
-                >= self._forward_offsets[self._pp_size - 1][mb] + self._forward_length
+                >= self._forward_offsets[self._pp_size - 1][mb]
+                + self._z3_forward_length
             )
 
+        self._solver.add(*cs)
+
     def _sequential_order_constraint_double_interleaving(self):
+        cs = []
         for mb in range(self._num_microbatches):
             # down pipe
             down_case = z3.And(
                 *[
                     self._forward_offsets[i][mb]
-                    >= self._forward_offsets[i - 1][mb] + self._forward_length
+                    >= self._forward_offsets[i - 1][mb] + self._z3_forward_length
                     for i in range(1, self._pp_size)
                 ],
                 *[
                     self._backward_offsets[i - 1][mb]
-                    >= self._backward_offsets[i][mb] + self._backward_length
+                    >= self._backward_offsets[i][mb] + self._z3_backward_length
                     for i in range(self._pp_size - 1, 0, -1)
                 ],
                 self._backward_offsets[self._pp_size - 1][mb]
-                >= self._forward_offsets[self._pp_size - 1][mb] + self._forward_length,
+                >= self._forward_offsets[self._pp_size - 1][mb]
+                + self._z3_forward_length,
             )
             # up pipe
             up_case = z3.And(
                 *[
                     self._forward_offsets[i - 1][mb]
-                    >= self._forward_offsets[i][mb] + self._forward_length
+                    >= self._forward_offsets[i][mb] + self._z3_forward_length
                     for i in range(self._pp_size - 1, 0, -1)
                 ],
                 *[
                     self._backward_offsets[i][mb]
-                    >= self._backward_offsets[i - 1][mb] + self._backward_length
+                    >= self._backward_offsets[i - 1][mb] + self._z3_backward_length
                     for i in range(1, self._pp_size)
                 ],
                 self._backward_offsets[0][mb]
-                >= self._forward_offsets[0][mb] + self._forward_length,
+                >= self._forward_offsets[0][mb] + self._z3_forward_length,
             )
 
-            self._solver.add(z3.Or(down_case, up_case))
+            cs.append(z3.Or(down_case, up_case))
+
+        self._solver.add(*cs)
 
     def _sequential_order_constraint_full_interleaving(self):
+        cs = []
         for mb in range(self._num_microbatches):
-            cases = []
-
-            for perm in itertools.permutations(range(self._pp_size)):
-                cases.append(
-                    z3.And(
-                        # forward sequential order
-                        *[
-                            self._forward_offsets[perm[i + 1]][mb]
-                            >= self._forward_offsets[perm[i]][mb] + self._forward_length
-                            for i in range(len(perm) - 1)
-                        ],
-                        # corresponding backward order
-                        *[
-                            self._backward_offsets[perm[i - 1]][mb]
-                            >= self._backward_offsets[perm[i]][mb]
-                            + self._backward_length
-                            for i in range(len(perm) - 1, 0, -1)
-                        ],
-                        # forward-backward connection order
-                        self._backward_offsets[perm[-1]][mb]
-                        >= self._forward_offsets[perm[-1]][mb] + self._forward_length,
+            # position of each pipeline in the forward order of this microbatch
+            positions = [self._make_var(f"pos_{mb}_{i}") for i in range(self._pp_size)]
+            cs.append(z3.Distinct(*positions))
+
+            for i in range(self._pp_size):
+                cs.extend((positions[i] >= 0, positions[i] < self._pp_size))
+
+                for j in range(self._pp_size):
+                    if i == j:
+                        continue
+                    # pipeline j directly follows pipeline i
+                    _adjacent = positions[i] + 1 == positions[j]
+                    # forward sequential order
+                    cs.append(
+                        z3.Implies(
+                            _adjacent,
+                            self._forward_offsets[j][mb]
+                            >= self._forward_offsets[i][mb] + self._z3_forward_length,
+                        )
+                    )
+                    # corresponding backward order
+                    cs.append(
+                        z3.Implies(
+                            _adjacent,
+                            self._backward_offsets[i][mb]
+                            >= self._backward_offsets[j][mb] + self._z3_backward_length,
+                        )
+                    )
+
+                # forward-backward connection order
+                cs.append(
+                    z3.Implies(
+                        positions[i] == self._pp_size - 1,
+                        self._backward_offsets[i][mb]
+                        >= self._forward_offsets[i][mb] + self._z3_forward_length,
                     )
                 )
 
-            # add all possibilities to z3 constraints
-            self._solver.add(z3.Or(*cases))
+        self._solver.add(*cs)
 
     def _serial_computation_within_pipeline_constraint(self):
+        cs = []
         for pp in range(self._pp_size):
             _pp_vars = self._forward_offsets[pp] + self._backward_offsets[pp]
+            _lengths = [self._z3_forward_length] * self._num_microbatches
+            _lengths += [self._z3_backward_length] * self._num_microbatches
             for i, _ in enumerate(_pp_vars):
+                _i_length = _lengths[i]
                 for j in range(i + 1, len(_pp_vars)):
-                    _i_length = (
-                        self._forward_length
-                        if i // self._num_microbatches == 0
-                        else self._backward_length
+                    _j_length = _lengths[j]
+                    # ordering variable: true if block i runs before block j
+                    _order = z3.Bool(f"ord_{pp}_{i}_{j}")
+                    cs.append(
+                        z3.Implies(_order, _pp_vars[j] >= _pp_vars[i] + _i_length)
                     )
-                    _j_length = (
-                        self._forward_length
-                        if j // self._num_microbatches == 0
-                        else self._backward_length
-                    )
-                    self._solver.add(
-                        z3.Or(
-                            _pp_vars[j] >= _pp_vars[i] + _i_length,
-                            _pp_vars[j] + _j_length <= _pp_vars[i],
+                    cs.append(
+                        z3.Implies(
+                            z3.Not(_order), _pp_vars[j] + _j_length <= _pp_vars[i]
                         )
                     )
 
+        self._solver.add(*cs)
+
     def _pipeline_activation_accumulation_constraint(self):
+        cs = []
         for pp in range(self._pp_size):
             # calculate the maximum activation value for this pp
             for mb in range(self._num_microbatches):
                 _backward_var = self._backward_offsets[pp][mb]
-                _actvaition_count = 1
+                _overlaps = []
 
                 for other_mb in range(self._num_microbatches):
                     if other_mb == mb:
                         continue
-                    _actvaition_count += z3.If(
-                        z3.And(
+                    # overlap variable: true if the activation of other_mb
+                    # is still alive when the backward of mb starts
+                    _overlap = z3.Bool(f"ov_{pp}_{mb}_{other_mb}")
+                    cs.append(
+                        _overlap
+                        == z3.And(
                             self._backward_offsets[pp][other_mb] > _backward_var,
                             self._forward_offsets[pp][other_mb] < _backward_var,
-                        ),
-                        1,
-                        0,
+                        )
+                    )
+                    _overlaps.append(_overlap)
+
+                # the activation of mb itself is always counted
+                cs.append(
+                    z3.PbLe(
+                        [(_overlap, 1) for _overlap in _overlaps],
+                        self._max_activation_times[pp] - 1,
                     )
+                )
 
-                self._solver.add(_actvaition_count <= self._max_activation_times[pp])
+        self._solver.add(*cs)
 
     def _build_constraints(self) -> None:
         for i in range(self._pp_size):
             for mb in range(self._num_microbatches):
-                self._forward_offsets[i].append(z3.Int(f"f_{mb}_{i}"))
-                self._solver.add(self._forward_offsets[i][-1] >= 0)
-                self._backward_offsets[i].append(z3.Int(f"b_{mb}_{i}"))
-                self._solver.add(self._backward_offsets[i][-1] >= 0)
+                self._forward_offsets[i].append(self._make_var(f"f_{mb}_{i}"))
+                self._backward_offsets[i].append(self._make_var(f"b_{mb}_{i}"))
+                self._all_vars.append(self._forward_offsets[i][-1])
+                self._all_vars.append(self._backward_offsets[i][-1])
+
+        # reuses the constraints built by an earlier run with the same config
+        cache_path = None
+        if self._constraint_cache_dir is not None:
+            cache_path = os.path.join(
+                self._constraint_cache_dir, f"{self._constraint_cache_key}.smt2"
+            )
+            if os.path.exists(cache_path):
+                try:
+                    self._solver.add(z3.parse_smt2_file(cache_path))
+                    return
+                except z3.Z3Exception:
+                    # a corrupted cache file is dropped and rebuilt
+                    os.remove(cache_path)
+
+        for i in range(self._pp_size):
+            for mb in range(self._num_microbatches):
+                self._solver.add(self._forward_offsets[i][mb] >= 0)
+                self._solver.add(
+                    self._forward_offsets[i][mb]
+                    <= self._makespan_upper_bound - self._forward_length
+                )
+                self._solver.add(self._backward_offsets[i][mb] >= 0)
+                self._solver.add(
+                    self._backward_offsets[i][mb]
+                    <= self._makespan_upper_bound - self._backward_length
+                )
 
         if self._sequential_order_constraint_strategy == "strict":
             # constraint 1-0: forward and backward of each microbatch
@@ -191,15 +347,67 @@ class Simulator:
         # constraint 3: the accumulation count of activations does not exceed max_activation_times
         self._pipeline_activation_accumulation_constraint()
 
-    def _build_optimize_objectives(self) -> None:
+        if cache_path is not None:
+            # writes to a temporary file first, so an interrupted run never
+            # leaves a partial cache file behind
+            os.makedirs(self._constraint_cache_dir, exist_ok=True)
+            with tempfile.NamedTemporaryFile(
+                "w",
+                encoding="utf-8",
+                dir=self._constraint_cache_dir,
+                suffix=".tmp",
+                delete=False,
+            ) as cache_file:
+                cache_file.write(self._solver.sexpr())
+            os.replace(cache_file.name, cache_path)
+
+    def _build_optimize_objectives(self) -> tuple:
         # 1. minimize the execution time of each microbatch
-        max_var = z3.Int("max_start_offset")
+        max_var = self._make_var("max_start_offset")
+        self._solver.add(max_var <= self._makespan_upper_bound)
+
+        # only the pipelines that can run the last backward of a microbatch
+        # need to be bounded, the sequential constraints cover the others
+        if self._sequential_order_constraint_strategy == "strict":
+            last_pipelines = [0]
+        elif self._sequential_order_constraint_strategy == "double_interleaving":
+            last_pipelines = [0, self._pp_size - 1]
+        else:
+            last_pipelines = range(self._pp_size)
+
+        self._solver.add(
+            *[
+                max_var >= var
+                for pp in last_pipelines
+                for var in self._backward_offsets[pp]
+            ]
+        )
+
+        # the last block is always a backward, so bound its start offset
+        return (
+            max_var,
+            self._makespan_lower_bound - self._backward_length,
+            self._makespan_upper_bound - self._backward_length,
+        )
+
+    def _heuristic_1f1b_schedule(self):
+        forward_starts, backward_starts = schedule_1f1b(
+            self._pp_size,
+            self._num_microbatches,
+            self._forward_length,
+            self._backward_length,
+            np.array(self._max_activation_times, dtype=np.int64),
+        )
+        if (backward_starts < 0).any():
+            return None
 
+        schedule = {}
         for pp in range(self._pp_size):
-            for var in self._backward_offsets[pp]:
-                self._solver.add(max_var >= var)
+            for mb in range(self._num_microbatches):
+                schedule[f"f_{mb}_{pp}"] = int(forward_starts[pp][mb])
+                schedule[f"b_{mb}_{pp}"] = int(backward_starts[pp][mb])
 
-        self._solver.minimize(max_var)
+        return schedule
 
     def _draw(self, results: dict) -> None:
         painter_conf = {
@@ -213,23 +421,95 @@ class Simulator:
 
         SchedulingPainter(painter_conf).draw(results)
 
-    def run(self) -> None:
-        """run simulation"""
-        # 1. builds the solver constraints.
-        self._build_constraints()
+    def solve(self, fixed_offsets: dict = None):
+        """solve the scheduling, optionally pinning some offsets by name"""
+        fixed_offsets = fixed_offsets or {}
+        self._timed_out = False
+
+        # 1. seeds the search with a heuristic 1F1B schedule, which is feasible
+        # under every strategy, so only strictly better schedules are searched.
+        results = None
+        if len(fixed_offsets) == 0:
+            results = self._heuristic_1f1b_schedule()
+        if results is not None:
+            makespan = (
+                max(val for key, val in results.items() if key.startswith("b"))
+                + self._backward_length
+            )
+            if makespan <= self._makespan_lower_bound:
+                # the heuristic schedule is already optimal, no need for z3
+                return results
+
+        # 2. builds the solver constraints and optimize objectives only once,
+        # later calls reuse the same solver.
+        if self._objective is None:
+            self._build_constraints()
+            self._objective = self._build_optimize_objectives()
+        max_var, lower, upper = self._objective
+        if results is not None:
+            upper = min(upper, makespan - self._backward_length - 1)
 
-        # 2. builds the solver optimize objectives.
-        self._build_optimize_objectives()
+        self._solver.push()
+        name2var = {str(var): var for var in self._all_vars}
+        for name, offset in fixed_offsets.items():
+            self._solver.add(name2var[name] == offset)
+
+        # microbatches are interchangeable, so fix their order at the first stage,
+        # unless pinned offsets already tell them apart
+        if self._break_microbatch_symmetry and len(fixed_offsets) == 0:
+            for mb in range(self._num_microbatches - 1):
+                self._solver.add(
+                    self._forward_offsets[0][mb] <= self._forward_offsets[0][mb + 1]
+                )
 
-        # 3. runs the solver.
+        # 3. runs the solver, binary searching the smallest feasible max_var,
+        # the best schedule found so far is kept when timeout_ms runs out.
         print("Z3 Solver Solving...")
-        if self._solver.check() == z3.sat:
-            print("Result: SAT")
-            # tranforms the result to a dictionary.
-            model = self._solver.model()
-            results = {str(key): model[key].as_long() for key in model}
-            results.pop('max_start_offset')
-            # 4. draws the result.
+        if self._timeout_ms is not None:
+            deadline = time.monotonic() + self._timeout_ms / 1000
+        while lower <= upper:
+            if self._timeout_ms is not None:
+                remaining_ms = int((deadline - time.monotonic()) * 1000)
+                if remaining_ms <= 0:
+                    self._timed_out = True
+                    break
+                self._solver.set("timeout", remaining_ms)
+
+            middle = (lower + upper) // 2
+            self._solver.push()
+            self._solver.add(max_var <= middle)
+            result = self._solver.check()
+            if result == z3.unknown:
+                self._timed_out = True
+                self._solver.pop()
+                break
+            if result == z3.sat:
+                # tranforms the result to a dictionary.
+                model = self._solver.model()
+                results = {
+                    str(var): model.eval(var, model_completion=True).as_long()
+                    for var in self._all_vars
+                }
+                upper = middle - 1
+            else:
+                lower = middle + 1
+            self._solver.pop()
+
+        self._solver.pop()
+
+        return results
+
+    def run(self) -> None:
+        """run simulation"""
+        results = self.solve()
+
+        if results is not None:
+            if self._timed_out:
+                print("Result: TIMEOUT (best-so-far)")
+            else:
+                print("Result: SAT")
             self._draw(results)
+        elif self._timed_out:
+            print("Result: TIMEOUT")
         else:
             print("Result: UNSAT")